@@ -1,7 +1,18 @@
 from os import getenv
+from logging.handlers import QueueHandler, QueueListener
 import argparse
+import logging
+import queue
+import sys
 from sharesight_api_client import SharesightApiClient
 from sharesight_csv_importer import SharesightCsvImporter
+from sharesight_sent_transactions import SharesightSentTransactions
+
+def positive_int(value):
+    number = int(value)
+    if (number < 1):
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description='Process some integers.')
@@ -12,12 +23,27 @@ def main():
     parser.add_argument('-c', '--country_code', type=str, required=True, help='The file name')
     parser.add_argument('-r', '--delete_existing', type=bool, action=argparse.BooleanOptionalAction, help='Remove the portfolio')
     parser.add_argument('-t', '--use_seperate_income_account', type=bool, action=argparse.BooleanOptionalAction, help='Use a seperate cash account for income')
+    parser.add_argument('-w', '--max_workers', type=positive_int, default=8, help='The maximum number of concurrent API requests')
+    parser.add_argument('-s', '--skip_sent', type=bool, action=argparse.BooleanOptionalAction, help='Remember sent transactions in a file next to the CSV, and skip them on later runs')
     parser.add_argument('-d', '--debug', type=bool, action=argparse.BooleanOptionalAction, help='Output curl requests')
 
     args = parser.parse_args()
 
-    api_client = SharesightApiClient(args.client_id, args.client_secret, args.debug)
-    csv_importer = SharesightCsvImporter(api_client)
-    csv_importer.import_file(args.file_name, args.portfolio_name, args.country_code, args.use_seperate_income_account, args.delete_existing)
+    # import workers only enqueue log records, a single listener thread writes them out
+    log_queue = queue.Queue()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(log_queue)])
+    log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    log_listener.start()
+    sent_transactions = None
+    try:
+        if (args.skip_sent):
+            sent_transactions = SharesightSentTransactions(f"{args.file_name}.sent.sqlite")
+        api_client = SharesightApiClient(args.client_id, args.client_secret, args.debug, args.max_workers)
+        csv_importer = SharesightCsvImporter(api_client, args.max_workers, sent_transactions)
+        csv_importer.import_file(args.file_name, args.portfolio_name, args.country_code, args.use_seperate_income_account, args.delete_existing)
+    finally:
+        if (sent_transactions):
+            sent_transactions.close()
+        log_listener.stop()
 
 main()
@@ -1,5 +1,11 @@
 import curlify
+import logging
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
 
 class SharesightApiClient:
     
@@ -7,9 +13,24 @@ class SharesightApiClient:
     API_V3_BASE_URL = "https://api.sharesight.com/api/v3/"
     _output_curl = False
     _access_token = None
+    _session = None
+    _portfolios = None
 
-    def __init__(self, client_id: str, client_secret: str, output_curl: bool):
+    def __init__(self, client_id: str, client_secret: str, output_curl: bool, max_connections: int = 10):
         self._output_curl = output_curl
+        # keep connections alive between requests, with enough of them for every import worker
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_maxsize=max_connections, max_retries=Retry(
+            total=5,
+            # most of our requests are POSTs, so only retry when the request was rejected without being processed
+            read=0,
+            status_forcelist=(429, 503),
+            allowed_methods=None,
+            # waits for Retry-After when the response has one
+            backoff_factor=0.5,
+            # hand the final response back, as the try_ methods check the status themselves
+            raise_on_status=False
+        )))
         # access token is valid for 30 minutes which is sufficiently
         # long to avoid refreshing the token for our purposes
         self._access_token = self._get_access_token(client_id, client_secret)
@@ -23,17 +44,21 @@ class SharesightApiClient:
             'client_id': client_id,
             'client_secret': client_secret
         }
-        response = self._make_request('post', token_url, headers=None, json=payload).json()
+        response = self._make_json_request('post', token_url, json=payload)
         return response['access_token']
     
     def _make_request_without_status_check(self, method, url, headers=None, json=None):
+        # requests only sets the content type itself when given json=, which would use the stdlib encoder
         default_headers = {
             "Authorization": "Bearer " + self._access_token,
             "Content-Type": "application/json"
-        } if self._access_token else {}
-        response = requests.request(method, url, json=json, headers = headers or default_headers)
+        } if self._access_token else {
+            "Content-Type": "application/json"
+        }
+        data = orjson.dumps(json) if json is not None else None
+        response = self._session.request(method, url, data=data, headers = headers or default_headers)
         if (self._output_curl):
-            print(curlify.to_curl(response.request))
+            logger.info(curlify.to_curl(response.request))
         return response
 
     def _make_request(self, method, url, headers=None, json=None):
@@ -41,33 +66,48 @@ class SharesightApiClient:
         response.raise_for_status()
         return response
 
+    def _make_json_request(self, method, url, json=None):
+        return orjson.loads(self._make_request(method, url, json=json).content)
+
+    def invalidate_cache(self):
+        self._portfolios = None
+
     def delete_portfolio(self, portfolio_id):
-        return self._make_request('delete', 
+        response = self._make_request('delete', 
             f'{self.API_V2_BASE_URL}portfolios/{portfolio_id}.json'
         )
+        self.invalidate_cache()
+        return response
 
     def update_portfolio(self, portfolio_id, data):
-        return self._make_request('put', 
+        response = self._make_json_request('put', 
             f"{self.API_V2_BASE_URL}portfolios/{portfolio_id}.json", 
             json={'portfolio': data}
-        ).json()
+        )
+        self.invalidate_cache()
+        return response
 
     def create_portfolio(self, data):
-        return self._make_request('post', 
+        response = self._make_json_request('post', 
             f"{self.API_V2_BASE_URL}portfolios.json", 
             json={'portfolio': data}
-        ).json()
+        )
+        self.invalidate_cache()
+        return response
     
     def get_portfolio_holdings(self, portfolio_id):
-        return self._make_request('get',
+        return self._make_json_request('get',
             f"{self.API_V3_BASE_URL}portfolios/{portfolio_id}/holdings"
-        ).json()
+        )
 
     def create_cash_account(self, portfolio_id, data):
-        return self._make_request('post', 
+        response = self._make_json_request('post', 
             f"{self.API_V2_BASE_URL}portfolios/{portfolio_id}/cash_accounts.json", 
             json={'cash_account': data}
-        ).json()
+        )
+        # the portfolio records which cash accounts it syncs to
+        self.invalidate_cache()
+        return response
 
     def resync_cash_account(self, cash_account_id):
         # note - undocumented API
@@ -76,14 +116,17 @@ class SharesightApiClient:
         )
 
     def get_portfolios(self):
-        return self._make_request('get', 
-            f"{self.API_V2_BASE_URL}portfolios.json"
-        ).json()
+        # cached until we create, change or delete a portfolio, as every import looks its portfolio up by name
+        if self._portfolios is None:
+            self._portfolios = self._make_json_request('get', 
+                f"{self.API_V2_BASE_URL}portfolios.json"
+            )
+        return self._portfolios
 
     def get_payouts(self, portfolio_id, date):
-        return self._make_request('get', 
+        return self._make_json_request('get', 
             f"{self.API_V2_BASE_URL}portfolios/{portfolio_id}/payouts.json?start_date={date}&end_date={date}"
-        ).json()
+        )
 
     def try_create_trade(self, trade_data):
         return self._make_request_without_status_check('post', 
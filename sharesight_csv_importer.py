@@ -1,6 +1,17 @@
 import csv
-from typing import TextIO
+import logging
+import orjson
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional, TextIO
 from sharesight_api_client import SharesightApiClient
+from sharesight_sent_transactions import SharesightSentTransactions
+
+logger = logging.getLogger(__name__)
 
 # to simplify usage, the following API fields are mapped to the same column values when required
 
@@ -17,6 +28,22 @@ from sharesight_api_client import SharesightApiClient
 # foreign_identifier -> unique_identifier (used by trade)
 # date_time -> transaction_date (used by trade)
 
+@dataclass(frozen=True)
+class CountryProfile:
+    exchange_rate_column: Optional[str] = None
+    # when currency of cash account doesn't match the portfolio, we need to record in the cash account too
+    record_in_cash_account: bool = False
+
+    @classmethod
+    def for_code(cls, country_code: str):
+        match country_code:
+            case "GB":
+                return cls(exchange_rate_column="exchange_rate_gbp")
+            case "AU":
+                return cls(exchange_rate_column="exchange_rate_aud", record_in_cash_account=True)
+            case _:
+                return cls()
+
 class SharesightCsvImporter:
     
     TRANSACTION_TYPE_TO_API_ENDPOINT = {
@@ -37,52 +64,132 @@ class SharesightCsvImporter:
         "FEE": "cash",
         "FEE_REIMBURSEMENT": "cash"
     }
-    def __init__(self, api_client: SharesightApiClient):
+    CAPITAL_CALL_OR_RETURN_TYPES = frozenset({"CAPITAL_CALL", "CAPITAL_RETURN"})
+    def __init__(self, api_client: SharesightApiClient, max_workers: int = 8, sent_transactions: Optional[SharesightSentTransactions] = None):
         self._api_client = api_client
+        self._max_workers = max_workers
+        self._sent_transactions = sent_transactions
 
-    def get_portfolio_holdings_lookup_key(self, portfolio_id, symbol, market):
-        return f"{portfolio_id}-{market}-{symbol}"
+    def get_portfolio_holdings_lookup_key(self, symbol, market):
+        # portfolio id is fixed for the duration of an import, so isn't part of the key
+        return (market, symbol)
     
     def import_file(self, file_path: TextIO, portfolio_name: str, country_code: str, use_seperate_income_account: bool, delete_existing: bool):
         portfolio_id, capital_cash_account_id, income_cash_account_id = self._get_or_create_portfolio(portfolio_name, country_code, use_seperate_income_account, delete_existing)
-        
-        portfolio_holdings = self._api_client.get_portfolio_holdings(portfolio_id)['holdings']
-        # print(portfolio_holdings)
-        portfolio_holdings_lookup = {self.get_portfolio_holdings_lookup_key(portfolio_id, h['instrument']['code'], h['instrument']['market_code']): h['id'] for h in portfolio_holdings}
-
-        with open(file_path, mode='r', encoding='utf-8-sig') as file:
-            reader = csv.DictReader(file)
-            print(f"Found columns in CSV: {reader.fieldnames}")
-            for data_row in reader:
-                log_line_prefix = f"Line {reader.line_num} ({data_row['transaction_type']})"
-                api_endpoint_type = self.TRANSACTION_TYPE_TO_API_ENDPOINT.get(data_row.get('transaction_type'))
-                holding_id_lookup_key = self.get_portfolio_holdings_lookup_key(portfolio_id, data_row.get("symbol"), data_row.get("market"))
+
+        # country code is fixed for the whole import, so resolve everything that depends on it once
+        country_profile = CountryProfile.for_code(country_code)
+        # set when the import has to stop, so holding groups that are already running don't send another row
+        stop_event = threading.Event()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            try:
+                # fetch the existing holdings while we read the file
+                portfolio_holdings_future = executor.submit(self._api_client.get_portfolio_holdings, portfolio_id)
+                rows_by_holding_key, cash_rows, is_complete = self._read_rows(file_path, capital_cash_account_id, income_cash_account_id)
+                portfolio_holdings = portfolio_holdings_future.result()['holdings']
+                # print(portfolio_holdings)
+                portfolio_holdings_lookup = {self.get_portfolio_holdings_lookup_key(h['instrument']['code'], h['instrument']['market_code']): h['id'] for h in portfolio_holdings}
+
+                futures = [executor.submit(self._process_holding_rows, stop_event, portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, delete_existing, portfolio_holdings_lookup, holding_id_lookup_key, rows) for holding_id_lookup_key, rows in rows_by_holding_key.items()]
+                futures += [executor.submit(self._process_cash, cash_account_id, log_line_prefix, data_row) for cash_account_id, log_line_prefix, data_row in cash_rows]
+                self._wait_for_all(futures)
+                if (not is_complete):
+                    return None
+                logger.info("Syncing cash accounts")
+                # the income account is the capital account unless a seperate one was requested, and
+                # an existing portfolio may not have sync accounts set at all
+                list(executor.map(self._api_client.resync_cash_account, {capital_cash_account_id, income_cash_account_id} - {None}))
+            except BaseException as error:
+                # a worker failed or we were interrupted, so don't start any more rows and let the ones in flight finish
+                stop_event.set()
+                executor.shutdown(cancel_futures=True)
+                self._log_other_failures(futures, error)
+                raise
+
+    def _wait_for_all(self, futures):
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if (future.done() and future.exception()):
+                raise future.exception()
+
+    def _log_other_failures(self, futures, error):
+        # the error being raised is reported by the caller, so only the others need logging here
+        for future in futures:
+            if (not future.cancelled() and future.exception() and future.exception() is not error):
+                logger.error("Import worker failed", exc_info=future.exception())
+
+    def _read_rows(self, file_path, capital_cash_account_id, income_cash_account_id):
+        # rows for the same holding must be sent in file order, but are independent of rows
+        # for any other holding. cash transactions don't depend on each other at all
+        rows_by_holding_key = defaultdict(list)
+        cash_rows = []
+        with open(file_path, mode='r', encoding='utf-8-sig', buffering=1048576, newline='') as file:
+            # zipping each row against the header is slightly cheaper than going through DictReader
+            reader = csv.reader(file)
+            fieldnames = next(reader, None)
+            field_count = len(fieldnames) if fieldnames else 0
+            logger.info(f"Found columns in CSV: {fieldnames}")
+            # bound once, as these are looked up for every row
+            transaction_type_to_api_endpoint = self.TRANSACTION_TYPE_TO_API_ENDPOINT
+            get_portfolio_holdings_lookup_key = self.get_portfolio_holdings_lookup_key
+            for row in reader:
+                if not row:
+                    # skip blank lines, as DictReader did
+                    continue
+                if (len(row) < field_count):
+                    # short rows get None for their missing columns, as DictReader did
+                    row += [None] * (field_count - len(row))
+                data_row = dict(zip(fieldnames, row))
+                transaction_type = data_row.get('transaction_type')
+                if (transaction_type is not None):
+                    # interned so every row shares one string per type, and comparisons against the literals hit on identity
+                    transaction_type = data_row['transaction_type'] = sys.intern(transaction_type)
+                log_line_prefix = f"Line {reader.line_num} ({transaction_type})"
+                api_endpoint_type = transaction_type_to_api_endpoint.get(transaction_type)
                 match api_endpoint_type:
-                    case 'trade':
-                        created_holding_id = self._process_trade(portfolio_id, country_code, capital_cash_account_id, income_cash_account_id, log_line_prefix, data_row)
-                        if(created_holding_id):
-                            portfolio_holdings_lookup[holding_id_lookup_key] = created_holding_id
-                        else:
-                            print(f"Missing holding id for {holding_id_lookup_key}")
-                    case 'payout':
-                        # cannot rely on using symbol/market directly, as this doesn't work for custom instruments
-                        existing_holding_id = portfolio_holdings_lookup.get(holding_id_lookup_key)
-                        if (existing_holding_id == None):
-                            print(f'{log_line_prefix}: Unable to find holding id matching {data_row.get("symbol")}, {data_row.get("market")}, skipping payout')
-                        elif (not delete_existing):
-                            print(f"{log_line_prefix}: Skipping for now, as we cannot prevent duplicates when not a fresh portfolio")
-                        else:
-                            self._process_payout(portfolio_id, country_code, income_cash_account_id, log_line_prefix, data_row, existing_holding_id)
+                    case 'trade' | 'payout':
+                        holding_id_lookup_key = get_portfolio_holdings_lookup_key(data_row.get("symbol"), data_row.get("market"))
+                        rows_by_holding_key[holding_id_lookup_key].append((log_line_prefix, api_endpoint_type, data_row))
                     case 'cash':
                         cash_account_id = income_cash_account_id if data_row.get("cash_account") == "INCOME" else capital_cash_account_id
-                        self._process_cash(cash_account_id, log_line_prefix, data_row)
+                        cash_rows.append((cash_account_id, log_line_prefix, data_row))
                     case _:
-                        print(f"{log_line_prefix}: Unable to map {data_row.get('transaction_type')} to an API endpoint")
-                        return None
-        print(f"Syncing cash accounts")
-        self._api_client.resync_cash_account(capital_cash_account_id)
-        if (income_cash_account_id!=capital_cash_account_id):
-            self._api_client.resync_cash_account(income_cash_account_id)
+                        logger.error(f"{log_line_prefix}: Unable to map {transaction_type} to an API endpoint")
+                        return rows_by_holding_key, cash_rows, False
+        return rows_by_holding_key, cash_rows, True
+
+    def _process_holding_rows(self, stop_event, portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, delete_existing, portfolio_holdings_lookup, holding_id_lookup_key, rows):
+        # everything but the row itself is fixed for the group, so bind it once up front
+        handlers = {
+            'trade': partial(self._process_trade_row, portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, portfolio_holdings_lookup, holding_id_lookup_key),
+            'payout': partial(self._process_payout_row, portfolio_id, country_profile, income_cash_account_id, delete_existing, portfolio_holdings_lookup, holding_id_lookup_key)
+        }
+        for log_line_prefix, api_endpoint_type, data_row in rows:
+            if (stop_event.is_set()):
+                return
+            handlers[api_endpoint_type](log_line_prefix, data_row)
+
+    def _process_trade_row(self, portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, portfolio_holdings_lookup, holding_id_lookup_key, log_line_prefix, data_row):
+        created_holding_id, is_already_sent = self._process_trade(portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, log_line_prefix, data_row)
+        if (is_already_sent):
+            # not sent this time, so there's no holding id to expect back
+            return
+        if(created_holding_id):
+            # only this worker reads or writes this key, so no lock is needed
+            portfolio_holdings_lookup[holding_id_lookup_key] = created_holding_id
+        else:
+            logger.warning(f"Missing holding id for {holding_id_lookup_key}")
+
+    def _process_payout_row(self, portfolio_id, country_profile, income_cash_account_id, delete_existing, portfolio_holdings_lookup, holding_id_lookup_key, log_line_prefix, data_row):
+        # cannot rely on using symbol/market directly, as this doesn't work for custom instruments
+        existing_holding_id = portfolio_holdings_lookup.get(holding_id_lookup_key)
+        if (existing_holding_id == None):
+            logger.warning(f'{log_line_prefix}: Unable to find holding id matching {data_row.get("symbol")}, {data_row.get("market")}, skipping payout')
+        elif (not delete_existing):
+            logger.info(f"{log_line_prefix}: Skipping for now, as we cannot prevent duplicates when not a fresh portfolio")
+        else:
+            self._process_payout(portfolio_id, country_profile, income_cash_account_id, log_line_prefix, data_row, existing_holding_id)
 
     def _get_portfolio_by_name(self, portfolio_name: str):
         portfolios = self._api_client.get_portfolios().get('portfolios', [])
@@ -96,7 +203,7 @@ class SharesightCsvImporter:
             return None, None, None
 
     def _create_portfolio_and_cash_accounts(self, portfolio_name: str, country_code: str, use_seperate_income_account: bool):
-        print("Creating portfolio")
+        logger.info("Creating portfolio")
         portfolio_data = {
                 "name": portfolio_name,
                 "country_code": country_code,
@@ -104,12 +211,12 @@ class SharesightCsvImporter:
                 "broker_email_api_enabled": False
             }
         portfolio_id = self._api_client.create_portfolio(portfolio_data).get('id')
-        print(f"Created portfolio {portfolio_id}")
+        logger.info(f"Created portfolio {portfolio_id}")
         capital_cash_account_id = self._api_client.create_cash_account(portfolio_id, {"name": f"{portfolio_name} Capital Account", "currency": "GBP"}).get('cash_account').get('id')
-        print(f"Created cash account {capital_cash_account_id}")
+        logger.info(f"Created cash account {capital_cash_account_id}")
         if (use_seperate_income_account):
             income_cash_account_id = self._api_client.create_cash_account(portfolio_id, {"name": f"{portfolio_name} Income Account", "currency": "GBP"}).get('cash_account').get('id')
-            print(f"Created income cash account {income_cash_account_id}")
+            logger.info(f"Created income cash account {income_cash_account_id}")
         else:
             income_cash_account_id = capital_cash_account_id
        # self._api_client.update_portfolio(portfolio_id, {"trade_sync_cash_account_id": capital_cash_account_id, "payout_sync_cash_account_id": income_cash_account_id })
@@ -118,51 +225,72 @@ class SharesightCsvImporter:
     def _get_or_create_portfolio(self, portfolio_name, country_code, use_seperate_income_account, delete_existing):
         portfolio_id, capital_cash_account_id, income_cash_account_id = self._get_portfolio_by_name(portfolio_name)
         if (portfolio_id and delete_existing):
-            print(f"Removing portfolio {portfolio_id}")
+            logger.info(f"Removing portfolio {portfolio_id}")
             self._api_client.delete_portfolio(portfolio_id)
             portfolio_id, capital_cash_account_id, income_cash_account_id = None, None, None
         if (portfolio_id == None):
             portfolio_id, capital_cash_account_id, income_cash_account_id = self._create_portfolio_and_cash_accounts(portfolio_name, country_code, use_seperate_income_account)
         return portfolio_id,capital_cash_account_id,income_cash_account_id
     
-    def _process_trade(self, portfolio_id, country_code, capital_cash_account_id, income_cash_account_id, log_line_prefix, data_row):
-        is_capital_call_or_return = data_row.get("transaction_type") == "CAPITAL_CALL" or data_row.get("transaction_type") == "CAPITAL_RETURN"
+    def _process_trade(self, portfolio_id, country_profile, capital_cash_account_id, income_cash_account_id, log_line_prefix, data_row):
+        # read each column once, several are used more than once below
+        get = data_row.get
+        transaction_type = get("transaction_type")
+        transaction_date = get("transaction_date")
+        amount = get("amount")
+        is_capital_call_or_return = transaction_type in self.CAPITAL_CALL_OR_RETURN_TYPES
         api_request_data = {
-            "unique_identifier": data_row.get("unique_identifier"),
-            "transaction_type": data_row.get("transaction_type"),
-            "transaction_date": data_row.get("transaction_date"),
+            "unique_identifier": get("unique_identifier"),
+            "transaction_type": transaction_type,
+            "transaction_date": transaction_date,
             "portfolio_id": portfolio_id,
-            "symbol": data_row.get("symbol"),
-            "market": data_row.get("market"),
-            "quantity": data_row.get("quantity"),
-            "price": data_row.get("price"),
-            "goes_ex_on": data_row.get("goes_ex_on"),
-            "brokerage": data_row.get("brokerage"),
-            "brokerage_currency_code": data_row.get("brokerage_currency_code"),
-            "exchange_rate": data_row.get("exchange_rate_gbp") if country_code == "GB" and data_row.get("exchange_rate_gbp") else data_row.get("exchange_rate_aud") if country_code=="AU" and data_row.get("exchange_rate_aud") else "1",
-            "cost_base": data_row.get("amount") if data_row.get("transaction_type") == "OPENING_BALANCE" else "",
-            "capital_return_value": str(abs(float(data_row.get("amount")))) if is_capital_call_or_return else "",
-            "paid_on": data_row.get("transaction_date") if is_capital_call_or_return else "",
-            "comments": data_row.get("comments")
+            "symbol": get("symbol"),
+            "market": get("market"),
+            "quantity": get("quantity"),
+            "price": get("price"),
+            "goes_ex_on": get("goes_ex_on"),
+            "brokerage": get("brokerage"),
+            "brokerage_currency_code": get("brokerage_currency_code"),
+            "exchange_rate": self._get_exchange_rate(country_profile, data_row),
+            "cost_base": amount if transaction_type == "OPENING_BALANCE" else "",
+            "capital_return_value": self._get_absolute_amount(amount) if is_capital_call_or_return else "",
+            "paid_on": transaction_date if is_capital_call_or_return else "",
+            "comments": get("comments")
         }
-        response = self._api_client.try_create_trade(api_request_data)
-        self.print_response_status(log_line_prefix, api_request_data, response)
-        if (response.status_code != 200 and data_row.get("transaction_type") == "OPENING_BALANCE"):
-            # errors = response_json.get('errors')
-            # is_duplicate_tx = errors and 'unique_identifier' in errors and errors['unique_identifier'][0] == "A tr
-            print(f"{log_line_prefix}: Falling back to BUY transaction type, this will need modifying in the UI")
-            api_request_data['transaction_type'] = "BUY"
+        is_already_sent = self._was_already_sent("trade", portfolio_id, api_request_data["unique_identifier"], log_line_prefix)
+        if (is_already_sent):
+            holding_id = None
+        else:
             response = self._api_client.try_create_trade(api_request_data)
-            self.print_response_status(log_line_prefix, api_request_data, response)
-        response_data = response.json().get('trade')
-        holding_id = response_data.get('holding_id') if response_data else None
+            is_sent = self.check_response_status(log_line_prefix, api_request_data, response)
+            if (response.status_code != 200 and transaction_type == "OPENING_BALANCE"):
+                # errors = response_json.get('errors')
+                # is_duplicate_tx = errors and 'unique_identifier' in errors and errors['unique_identifier'][0] == "A tr
+                logger.info(f"{log_line_prefix}: Falling back to BUY transaction type, this will need modifying in the UI")
+                api_request_data['transaction_type'] = "BUY"
+                response = self._api_client.try_create_trade(api_request_data)
+                is_sent = self.check_response_status(log_line_prefix, api_request_data, response)
+            if (is_sent):
+                self._record_sent("trade", portfolio_id, api_request_data["unique_identifier"])
+            # failed responses carry no trade, and have already been parsed for logging
+            response_data = orjson.loads(response.content).get('trade') if response.status_code == 200 else None
+            holding_id = response_data.get('holding_id') if response_data else None
         # create payout too as sharesight doesn't duplicate these into the cash account
-        if is_capital_call_or_return or country_code == "AU":
+        if is_capital_call_or_return or country_profile.record_in_cash_account:
             cash_account_id = income_cash_account_id if is_capital_call_or_return else capital_cash_account_id
             self._process_cash(cash_account_id, log_line_prefix, data_row)
-        return holding_id
+        return holding_id, is_already_sent
+
+    def _get_absolute_amount(self, amount):
+        # drop the sign from the text rather than round tripping through float, which can change the value sent
+        amount = amount.strip()
+        return amount[1:] if amount[:1] in ("-", "+") else amount
+
+    def _get_exchange_rate(self, country_profile, data_row):
+        exchange_rate_column = country_profile.exchange_rate_column
+        return (exchange_rate_column and data_row.get(exchange_rate_column)) or "1"
 
-    def _process_payout(self, portfolio_id, country_code, income_cash_account_id, log_line_prefix, data_row, existing_holding_id):
+    def _process_payout(self, portfolio_id, country_profile, income_cash_account_id, log_line_prefix, data_row, existing_holding_id):
         api_request_data = {
             "portfolio_id": portfolio_id,
             "holding_id": existing_holding_id,
@@ -170,12 +298,11 @@ class SharesightCsvImporter:
             "amount": data_row.get("amount"),
             "goes_ex_on": data_row.get("goes_ex_on"),
             "currency_code": data_row.get("currency_code"),
-            "exchange_rate": data_row.get("exchange_rate_gbp") if country_code == "GB" and data_row.get("exchange_rate_gbp") else data_row.get("exchange_rate_aud") if country_code=="AU" and data_row.get("exchange_rate_aud") else "1",
+            "exchange_rate": self._get_exchange_rate(country_profile, data_row),
         }
         response = self._api_client.try_create_payout(api_request_data)
-        self.print_response_status(log_line_prefix, api_request_data, response)
-        # when currency of cash account doesn't match the portfolio, we need to record in the cash account too
-        if country_code == "AU":
+        self.check_response_status(log_line_prefix, api_request_data, response)
+        if country_profile.record_in_cash_account:
             self._process_cash(income_cash_account_id, log_line_prefix, data_row)
     
     def _process_cash(self, cash_account_id, log_line_prefix, data_row):
@@ -186,18 +313,40 @@ class SharesightCsvImporter:
             "type_name": data_row.get("transaction_type"),
             "foreign_identifier": data_row.get("unique_identifier"),
         }
+        if (self._was_already_sent("cash", cash_account_id, api_request_data["foreign_identifier"], log_line_prefix)):
+            return
         response = self._api_client.try_create_cash_transaction(cash_account_id, api_request_data)
-        self.print_response_status(log_line_prefix, api_request_data, response)
+        if (self.check_response_status(log_line_prefix, api_request_data, response)):
+            self._record_sent("cash", cash_account_id, api_request_data["foreign_identifier"])
+
+    def _was_already_sent(self, endpoint, destination_id, unique_identifier, log_line_prefix):
+        # without a unique identifier sharesight can't spot a duplicate either, so always send those
+        if (self._sent_transactions and unique_identifier and self._sent_transactions.contains(endpoint, destination_id, unique_identifier)):
+            logger.info(f"{log_line_prefix}: Skipped (already sent)")
+            return True
+        return False
+
+    def _record_sent(self, endpoint, destination_id, unique_identifier):
+        if (self._sent_transactions and unique_identifier):
+            self._sent_transactions.add(endpoint, destination_id, unique_identifier)
 
-    def print_response_status(self, log_line_prefix, api_request_data, response):
+    def check_response_status(self, log_line_prefix, api_request_data, response):
+        # logs the outcome, and returns whether the transaction is now in sharesight (from this request or an earlier one)
         if not (response.status_code == 200):
-            response_json = response.json()
+            try:
+                response_json = orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                # e.g. a 429 or 503 still failing once the client has run out of retries
+                logger.error(f"{log_line_prefix}: {response.status_code} {response.text} {api_request_data}")
+                return False
             errors = response_json.get('errors')
             is_duplicate_tx = errors and 'unique_identifier' in errors and errors['unique_identifier'][0] == "A trade with this unique_identifier already exists in the portfolio."
             is_duplicate_cash = errors and 'foreign_identifier' in errors and errors['foreign_identifier'][0] == "has already been taken"
             if not is_duplicate_tx and not is_duplicate_cash:
-                print(f"{log_line_prefix}: {response_json} {api_request_data}")
+                logger.error(f"{log_line_prefix}: {response_json} {api_request_data}")
+                return False
             else:
-                print(f"{log_line_prefix}: Skipped (duplicate)")
+                logger.info(f"{log_line_prefix}: Skipped (duplicate)")
         else:
-            print(f"{log_line_prefix}: Success")
+            logger.info(f"{log_line_prefix}: Success")
+        return True
@@ -0,0 +1,27 @@
+import sqlite3
+import threading
+
+class SharesightSentTransactions:
+
+    # transactions are keyed by where they were sent (portfolio id for trades, cash account id for cash),
+    # so a deleted and recreated portfolio starts with nothing recorded against it
+    def __init__(self, file_path: str):
+        # import workers share the connection, so every statement is made under the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS sent(endpoint TEXT, destination_id TEXT, unique_identifier TEXT, PRIMARY KEY (endpoint, destination_id, unique_identifier))")
+
+    def contains(self, endpoint: str, destination_id, unique_identifier: str):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM sent WHERE endpoint = ? AND destination_id = ? AND unique_identifier = ?", (endpoint, str(destination_id), unique_identifier)).fetchone()
+        return row is not None
+
+    def add(self, endpoint: str, destination_id, unique_identifier: str):
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO sent VALUES (?, ?, ?)", (endpoint, str(destination_id), unique_identifier))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()